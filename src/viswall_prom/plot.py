@@ -1,18 +1,26 @@
 # FUTURE: should we plot CPUs or nodes?
 
+import functools
+import itertools
+import os
+import tempfile
+import types
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from importlib.resources import files
 from pathlib import Path
 
-import matplotlib as mpl
-
-mpl.use('Agg')
-
 import click
+import matplotlib as mpl
+import matplotlib.collections
 import matplotlib.colors
 import matplotlib.dates
-import matplotlib.pyplot as plt
+import matplotlib.patches
+import matplotlib.ticker
 import numpy as np
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from PIL import Image
 
 from . import prom
@@ -34,25 +42,68 @@ CYCLE_OTHERS = matplotlib.colors.ListedColormap(
     ['#5A6D5A', '#A7856A', '#6B879F', '#AA9F8A', '#6B5F90']
 )
 
-HIDE_CPU = {
-    'eval',
-    'gpu',
-    'gpuxl',
-    'mem',
-}
+HIDE_CPU = frozenset(
+    (
+        'eval',
+        'gpu',
+        'gpuxl',
+        'mem',
+    )
+)
 
-HIDE_GPU = {
-    'v100-sxm2-32gb',
-}
+HIDE_GPU = frozenset(('v100-sxm2-32gb',))
+
+NICKNAME = types.MappingProxyType(
+    {
+        'a100-sxm4-80gb': 'a100-80gb',
+        'a100-sxm4-40gb': 'a100-40gb',
+    }
+)
 
-NICKNAME = {
-    'a100-sxm4-80gb': 'a100-80gb',
-    'a100-sxm4-40gb': 'a100-40gb',
+# fmt: off
+MONTH_ABBREV = (
+    'Jan.', 'Feb.', 'Mar.', 'Apr.', 'May', 'Jun.',
+    'Jul.', 'Aug.', 'Sep.', 'Oct.', 'Nov.', 'Dec.',
+)
+# fmt: on
+
+BAR_WIDTH = 0.8
+
+# Axes layout in inches, based on what constrained layout used to find for the
+# 1920x1080 figure at the default dpi of 120, with room on the left for five
+# character tick labels like '100 K'. The text is sized in points, so at a
+# higher dpi the figure is fewer inches across and labels can overlap.
+LAYOUT = {
+    'width_ratios': (12, 4, 4),
+    'margins': {'left': 0.75, 'right': 0.6, 'bottom': 0.48, 'top': 0.09},
+    'wspace': (0.2, 0.71),  # between columns; the right-side labels need more room
+    'hspace': 0.57,  # between rows
 }
 
 AXIS_LABEL_FONT = {'fontweight': 'bold'}
 
-plt.rcParams['font.family'] = 'monospace'
+mpl.rcParams['font.family'] = 'monospace'
+# Ticks on all four sides of every axes
+mpl.rcParams['xtick.top'] = True
+mpl.rcParams['ytick.right'] = True
+
+# Extra savefig arguments per output format. The image is rewritten often, so
+# favor fast encoding over file size. SVG skips rasterization entirely and leaves
+# it to the browser.
+SAVE_KWARGS = {
+    'png': {'pil_kwargs': {'compress_level': 1}},
+    'webp': {'pil_kwargs': {'method': 0, 'quality': 90}},
+    'svg': {},
+}
+
+# Used instead of SAVE_KWARGS with --optimize, when the image is served over a
+# slow link and a smaller file is worth the slower encoding. The quality is the
+# same: PNG is lossless either way, and WebP is lossy at the same quality setting.
+OPTIMIZE_SAVE_KWARGS = {
+    'png': {'pil_kwargs': {'optimize': True, 'compress_level': 9}},
+    'webp': {'pil_kwargs': {'method': 6, 'quality': 90}},
+    'svg': {},
+}
 
 CENTER_COLOR_REGISTRY = {}
 NODE_COLOR_REGISTRY = {}
@@ -75,28 +126,85 @@ NODE_COLOR_REGISTRY = {}
     '--dpi',
     '-p',
     default=120,
-    help='DPI for the output plot',
+    help='DPI for the output plot; the layout is tuned for the default',
 )
 @click.option(
     '--outfn',
     '-o',
     default=None,
-    help='Output filename for the plot (default: usage_<timestamp>.png)',
+    help='Output filename for the plot (default: usage_<timestamp>.<format>)',
+)
+@click.option(
+    '--format',
+    '-f',
+    'fmt',
+    type=click.Choice(list(SAVE_KWARGS)),
+    default=None,
+    help='Image format (default: from the --outfn extension, or png)',
+)
+@click.option(
+    '--no-cache',
+    is_flag=True,
+    default=False,
+    help='Fetch all data from Prometheus instead of reusing cached responses',
+)
+@click.option(
+    '--optimize',
+    is_flag=True,
+    default=False,
+    help='Compress the image harder for a smaller file, at the cost of encoding time',
 )
 def plot_usage(
-    outfn: str | None = None, days: int = 7, step: str = '1h', dpi: int = 144
+    outfn: str | None = None,
+    days: int = 7,
+    step: str = '1h',
+    dpi: int = 144,
+    fmt: str | None = None,
+    no_cache: bool = False,
+    optimize: bool = False,
 ):
-    # fmt: off
-    # Gather data
-    rusty_acct   = prom.get_usage_by("account", "rusty" , days, step)
-    rusty_nodes  = prom.get_usage_by("nodes"  , "rusty" , days, step)
-    rusty_gpus   = prom.get_usage_by("gputype"  , "rusty" , 0, '', "gpus")
-    popeye_acct  = prom.get_usage_by("account", "popeye", days, step)
-    popeye_nodes = prom.get_usage_by("nodes"  , "popeye", days, step)
-    rusty_max      = prom.get_max_resource("rusty", days, step)
-    rusty_max_gpus = prom.get_max_resource("rusty", 0, '', "gpus", "gputype")
-    popeye_max     = prom.get_max_resource("popeye", days, step)
-    # fmt: on
+    now = datetime.now()
+    if not outfn:
+        fmt = fmt or 'png'
+        timestamp = now.strftime(r'%Y-%m-%d_%H%M%S')
+        outfn = Path(f'usage_{timestamp}.{fmt}')
+    else:
+        outfn = Path(outfn)
+        suffix = outfn.suffix.lstrip('.').lower()
+        # Check before querying, rather than writing e.g. WebP into a .png file
+        if fmt and suffix and suffix != fmt:
+            raise click.BadParameter(
+                f'{fmt!r} does not match the extension of {str(outfn)!r}',
+                param_hint='--format',
+            )
+        fmt = fmt or suffix or 'png'
+
+    # Gather data. The queries are independent and network-bound, so run them
+    # concurrently. They share one end time so that the range queries line up.
+    cache = not no_cache
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        # fmt: off
+        rusty_acct     = executor.submit(prom.get_usage_by, "account", "rusty" , days, step, cache=cache, now=now)
+        rusty_nodes    = executor.submit(prom.get_usage_by, "nodes"  , "rusty" , days, step, cache=cache, now=now)
+        rusty_gpus     = executor.submit(prom.get_usage_by, "gputype", "rusty" , 0, '', "gpus", cache=cache, now=now)
+        popeye_acct    = executor.submit(prom.get_usage_by, "account", "popeye", days, step, cache=cache, now=now)
+        popeye_nodes   = executor.submit(prom.get_usage_by, "nodes"  , "popeye", days, step, cache=cache, now=now)
+        rusty_max      = executor.submit(prom.get_max_resource, "rusty" , days, step, cache=cache, now=now)
+        rusty_max_gpus = executor.submit(prom.get_max_resource, "rusty" , 0, '', "gpus", "gputype", cache=cache, now=now)
+        popeye_max     = executor.submit(prom.get_max_resource, "popeye", days, step, cache=cache, now=now)
+        # fmt: on
+
+    rusty_acct = rusty_acct.result()
+    rusty_nodes = rusty_nodes.result()
+    rusty_gpus = rusty_gpus.result()
+    popeye_acct = popeye_acct.result()
+    popeye_nodes = popeye_nodes.result()
+    rusty_max = rusty_max.result()
+    rusty_max_gpus = rusty_max_gpus.result()
+    popeye_max = popeye_max.result()
+
+    if cache:
+        prom.prune_cache()
 
     initialize_colors(
         CENTER_COLOR_REGISTRY,
@@ -109,16 +217,10 @@ def plot_usage(
     # node_colors = NODE_COLOR_REGISTRY
     node_colors = CENTER_COLORS['flatiron']
 
-    fig, axes = plt.subplots(
-        2,
-        3,
-        figsize=(1920 // dpi, 1080 // dpi),
-        dpi=dpi,
-        sharex=False,
-        sharey=False,
-        width_ratios=[12, 4, 4],
-        layout='constrained',
-    )
+    # Build the figure directly on an Agg canvas, bypassing pyplot's figure manager
+    fig = Figure(figsize=(1920 // dpi, 1080 // dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    axes = make_axes(fig)
 
     _plot_stacked(
         axes,
@@ -170,21 +272,64 @@ def plot_usage(
         (1, 2),
     )
 
-    if not outfn:
-        timestamp = datetime.now().strftime(r'%Y-%m-%d_%H%M%S')
-        outfn = Path(f'usage_{timestamp}.png')
-    else:
-        outfn = Path(outfn)
+    # Write to a temporary file and move it into place, so that anything watching
+    # the output never reads a partially written image. The name is unique, so
+    # overlapping runs can't move each other's partial files into place either.
+    with tempfile.NamedTemporaryFile(
+        'wb', dir=outfn.parent, prefix=f'.{outfn.name}.', suffix='.tmp', delete=False
+    ) as f:
+        tmpfn = Path(f.name)
+    try:
+        save_kwargs = OPTIMIZE_SAVE_KWARGS if optimize else SAVE_KWARGS
+        fig.savefig(tmpfn, format=fmt, **save_kwargs.get(fmt, {}))
+        # The temporary file is only readable by its owner; give the output the
+        # usual permissions for a new file so that e.g. a web server can read it
+        umask = os.umask(0)
+        os.umask(umask)
+        tmpfn.chmod(0o666 & ~umask)
+        os.replace(tmpfn, outfn)
+    finally:
+        tmpfn.unlink(missing_ok=True)
 
-    # Freeze the layout, then add the xlabel
-    # Couldn't figure out how otherwise exclude the xlabel from the spacing calculation
-    fig.canvas.draw()
-    fig.set_layout_engine('none')
-    axes[0, 2].set_xlabel('GPU Type', fontweight='bold')
+    print(f'Saved plot to {outfn}')
 
-    fig.savefig(outfn)
 
-    print(f'Saved plot to {outfn}')
+def make_axes(fig: Figure) -> np.ndarray:
+    """Add the 2x3 grid of axes to the figure at fixed positions.
+
+    The margins and spacing are in inches and leave room for the tick labels, axis
+    labels, and the staggered GPU names, so that no layout engine has to run.
+    """
+    fig_width, fig_height = fig.get_size_inches()
+    margins = LAYOUT['margins']
+
+    free_width = fig_width - margins['left'] - margins['right'] - sum(LAYOUT['wspace'])
+    widths = [
+        free_width * r / sum(LAYOUT['width_ratios']) for r in LAYOUT['width_ratios']
+    ]
+    lefts = [margins['left']]
+    for width, space in zip(widths, LAYOUT['wspace']):
+        lefts.append(lefts[-1] + width + space)
+
+    height = (fig_height - margins['bottom'] - margins['top'] - LAYOUT['hspace']) / 2
+    bottoms = [margins['bottom'] + height + LAYOUT['hspace'], margins['bottom']]
+
+    return np.array(
+        [
+            [
+                fig.add_axes(
+                    (
+                        left / fig_width,
+                        bottom / fig_height,
+                        width / fig_width,
+                        height / fig_height,
+                    )
+                )
+                for left, width in zip(lefts, widths)
+            ]
+            for bottom in bottoms
+        ]
+    )
 
 
 def _plot_stacked(
@@ -196,15 +341,30 @@ def _plot_stacked(
     color_registry: dict,
     cdf_threshold: float = CPU_PERCENT_THRESHOLD,
 ):
-    ax: plt.Axes = axes[pos]
+    ax: Axes = axes[pos]
     if not data:
         ax_no_data(ax, title)
         return
-    x_vals = data.pop('timestamps')
+    # Convert the timestamps once, rather than in every plot call. They're sorted,
+    # so the x limits are the first and last.
+    x_vals = mpl.dates.date2num(data['timestamps'])
+    data = {k: v for k, v in data.items() if k != 'timestamps'}
     data = sort_and_group(data, cdf_threshold)
     keys = list(data.keys())
-    # Create X values and prepare the stacked data
-    stack_data = [data[k] for k in keys]
+    # Prepare the stacked data as one float32 (keys, times) array, the same dtype
+    # as the series from prom, so matplotlib doesn't need to convert it
+    stack_data = np.asarray([data[k] for k in keys], dtype=np.float32)
+    capacity = max_data['total']
+
+    # There's no point drawing more than a couple of points per pixel, so thin out
+    # fine-stepped data. All series use the same points so the stack stays aligned.
+    bbox = ax.get_position()
+    max_points = 2 * int(bbox.width * ax.figure.get_figwidth() * ax.figure.dpi)
+    if len(x_vals) > max_points:
+        idx = lttb_indices(stack_data.sum(axis=0), max_points)
+        x_vals = x_vals[idx]
+        stack_data = stack_data[:, idx]
+        capacity = np.asarray(capacity)[idx]
 
     ax.stackplot(
         x_vals,
@@ -212,23 +372,14 @@ def _plot_stacked(
         labels=keys,
         colors=get_colors(color_registry, keys),
     )
-    ax.plot(x_vals, max_data['total'], label='Capacity', color='black', linestyle='-')
+    ax.plot(x_vals, capacity, label='Capacity', color='black', linestyle='-')
     ax.legend(loc='upper left', ncol=2, framealpha=0.95)
-    ax.set_xlim(left=min(x_vals), right=max(x_vals))
-    ax.set_ylim(top=max(max_data['total']) * 1.1)
+    ax.set_xlim(left=x_vals[0], right=x_vals[-1])
+    ax.set_ylim(top=np.max(max_data['total']) * 1.1)
 
-    # format x-axis labels as dates
-    ax.xaxis.set_major_formatter(date_formatter)
+    # one tick per day, labeled with the date
     ax.xaxis.set_major_locator(mpl.dates.DayLocator(interval=1))
-
-    ax.tick_params(
-        axis='both',
-        which='both',
-        left=True,
-        right=True,
-        top=True,
-        bottom=True,
-    )
+    freeze_xticks(ax)
 
     if pos[0] >= 1:
         ax.set_xlabel('Time', **AXIS_LABEL_FONT)
@@ -240,16 +391,11 @@ def _plot_stacked(
             which='both',
             labelleft=False,
             labelright=True,
-            right=True,
         )
 
     add_subplot_title(ax, title)
 
-    ax.yaxis.set_major_formatter(
-        mpl.ticker.FuncFormatter(
-            lambda x, pos: f'{x / 1_000:.0f} K' if x >= 1_000 else f'{x:.0f}'
-        )
-    )
+    freeze_yticks(ax)
 
 
 def _plot_bar_chart(
@@ -259,7 +405,7 @@ def _plot_bar_chart(
     max_data: list,
     title: str,
     colors: dict | str | None = None,
-    hide: set = None,
+    hide: frozenset = frozenset(),
     stagger_xlabels: bool = False,
     legend: bool = False,
 ):
@@ -267,21 +413,14 @@ def _plot_bar_chart(
     allocated. In other words, this is a snapshot of the latest cluster state, not a
     timeline. The capacity is shown as a hollow bar on top of the solid bars.
     """
-    ax: plt.Axes = axes[pos]
+    ax: Axes = axes[pos]
     if not data:
         ax_no_data(ax, title)
         return
-    data.pop('timestamps', None)
-    keys = list(data.keys())
-
-    # remove keys with zero max
-    keys = [k for k in keys if max_data[k] > 0]
-
-    # remove keys that are hidden
-    if hide:
-        keys = [k for k in keys if k not in hide]
-
-    keys.sort()
+    # skip keys with zero max and keys that are hidden
+    keys = sorted(
+        k for k in data if k != 'timestamps' and max_data[k] > 0 and k not in hide
+    )
 
     max_data = [max_data[k] for k in keys]
     data = [data[k] for k in keys]
@@ -292,40 +431,32 @@ def _plot_bar_chart(
         colors = get_colors(colors, keys)
 
     keylabels = [NICKNAME.get(k, k) for k in keys]
-
-    ax.bar(
-        keys,
-        data,
-        color=colors,
-        tick_label=keylabels,
-        label='Usage',
-    )
-
-    # for capacity, draw a hollow bar
-    ax.bar(
-        keys,
-        max_data,
-        color='none',
-        # edgecolor=get_colors(color_registry, keys),
-        edgecolor='black',
-        linewidth=1.5,
-        label='Capacity',
-    )
-
-    ax.tick_params(
-        axis='both',
-        which='both',
-        left=True,
-        right=True,
-        top=True,
-        bottom=True,
+    if stagger_xlabels:
+        # every other label one line lower, so that long names don't overlap
+        keylabels = ['\n' + L if i % 2 else L for i, L in enumerate(keylabels)]
+
+    # Draw the usage bars and the hollow capacity bars as a single collection
+    # rather than a patch per bar, with the bars centered on 0, 1, 2, ...
+    n = len(keys)
+    x = np.arange(n)
+    usage_colors = mpl.colors.to_rgba_array('C0' if colors is None else colors)
+    ax.add_collection(
+        mpl.collections.PolyCollection(
+            bar_verts(x, data) + bar_verts(x, max_data),
+            facecolors=np.concatenate(
+                [np.broadcast_to(usage_colors, (n, 4)), np.zeros((n, 4))]
+            ),
+            edgecolors=[(0, 0, 0, 0)] * n + ['black'] * n,
+            linewidths=[0] * n + [1.5] * n,
+            joinstyle='miter',
+        )
     )
+    ax.set_xticks(x, keylabels)
 
     if pos[1] == 0:
         ax.set_ylabel('CPU Cores', **AXIS_LABEL_FONT)
     if pos[1] == 1:
-        # Sadly constrained layout doesn't seem to be aware of the right-side label,
-        # hence the need for labelpad
+        # The rotated label needs extra padding to clear the tick labels
         ax.set_ylabel('CPU Cores', rotation=270, labelpad=15, **AXIS_LABEL_FONT)
         ax.yaxis.set_label_position('right')
     if pos[1] == 2:
@@ -337,93 +468,60 @@ def _plot_bar_chart(
             which='both',
             labelleft=False,
             labelright=True,
-            right=True,
         )
     if pos[1] == 1 and pos[0] == len(axes) - 1:
         ax.set_xlabel('CPU Type', fontweight='bold')
     if pos[1] == 2:
-        # This is deferred to later
-        # ax.set_xlabel('GPU Type', fontweight='bold')
-        pass
+        ax.set_xlabel('GPU Type', fontweight='bold')
     add_subplot_title(ax, title)
 
     if legend:
-        ax.legend()
-
-    ax.yaxis.set_major_formatter(
-        mpl.ticker.FuncFormatter(
-            lambda x, pos: f'{x / 1_000:.0f} K' if x >= 1_000 else f'{x:.0f}'
+        ax.legend(
+            handles=[
+                mpl.patches.Patch(facecolor=usage_colors[0], label='Usage'),
+                mpl.patches.Patch(
+                    facecolor='none', edgecolor='black', linewidth=1.5, label='Capacity'
+                ),
+            ]
         )
-    )
 
-    if stagger_xlabels:
-        labels = [label.get_text() for label in ax.get_xticklabels()]
-        new_labels = ['\n' + L if i % 2 else L for i, L in enumerate(labels)]
-        ax.set_xticklabels(new_labels)
+    freeze_yticks(ax)
 
 
 def _logo_plot(axes, pos: tuple[int, int]):
-    ax: plt.Axes = axes[pos]
+    ax: Axes = axes[pos]
     ax.set_axis_off()
 
     # Get figure and axes dimensions
     fig = ax.get_figure()
-    fig.canvas.draw()
     ax_bbox = ax.get_position()
 
-    # Load the QR code background image
-    qr_img = Image.open(files('viswall_prom').joinpath('grafana_qr.png'))
-    
-    # Load the SCC icon (foreground)
-    scc_img = Image.open(files('viswall_prom').joinpath('scc_icon.png')).convert('RGB')
-
-    # Calculate QR code dimensions and position in figure coordinates
+    # The QR code with the SCC icon over its center, as one image
     qr_ratio = 0.22
-    qr_aspect = qr_img.width / qr_img.height
-
-    # Resize the QR code image
-    qr_display_height = int(fig.bbox.height * qr_ratio)
-    qr_display_width = int(qr_display_height * qr_aspect)
-    qr_resized = qr_img.resize((qr_display_width, qr_display_height), Image.Resampling.NEAREST)
+    scc_ratio = 0.03
+    logo = load_logo(int(fig.bbox.height * qr_ratio), int(fig.bbox.height * scc_ratio))
 
-    # Position QR code in figure coordinates (center of axes + vertical offset)
+    # Position it in figure coordinates (center of axes + vertical offset)
     yoff = 0.0
     x_center = (ax_bbox.x0 + ax_bbox.width / 2) * fig.bbox.width
     y_center = (ax_bbox.y0 + ax_bbox.height / 2 + yoff) * fig.bbox.height
 
-    # Display QR code
+    logo_height, logo_width = logo.shape[:2]
     fig.figimage(
-        np.asarray(qr_resized),
-        xo=x_center - qr_resized.width / 2,
-        yo=y_center - qr_resized.height / 2,
+        logo,
+        xo=x_center - logo_width / 2,
+        yo=y_center - logo_height / 2,
         origin='upper',
-        cmap='gray',
     )
 
-    # Calculate SCC icon dimensions (smaller than QR code)
-    scc_ratio = 0.03
-    scc_aspect = scc_img.width / scc_img.height
-
-    # Resize the SCC icon
-    scc_display_height = int(fig.bbox.height * scc_ratio)
-    scc_display_width = int(scc_display_height * scc_aspect)
-    scc_resized = scc_img.resize((scc_display_width, scc_display_height), Image.Resampling.LANCZOS)
-
-    # Create a white background for the SCC logo
-    bg_padding = 10  # pixels of padding around the logo
-    bg_width = scc_resized.width + 2 * bg_padding
-    bg_height = scc_resized.height + 2 * bg_padding
-    white_bg = Image.new('RGB', (bg_width, bg_height), (255, 255, 255))
-    white_bg.paste(scc_resized, (bg_padding, bg_padding))
-    scc_with_bg = white_bg
-
-    # Display SCC icon centered over QR code
-    fig.figimage(
-        np.asarray(scc_with_bg),
-        xo=x_center - scc_with_bg.width / 2,
-        yo=y_center - scc_with_bg.height / 2,
-        origin='upper',
-    )
+    # Both text blocks share one style
+    text_style = {
+        'transform': fig.transFigure,
+        'fontweight': 'bold',
+        'horizontalalignment': 'center',
+        'fontsize': 'larger',
+        'color': 'black',
+    }
 
     # text above the images
     text_yoff = 0.11
@@ -431,32 +529,38 @@ def _logo_plot(axes, pos: tuple[int, int]):
         x_center / fig.bbox.width,
         y_center / fig.bbox.height + text_yoff,
         'Made by\nyour friends\nin SCC',
-        transform=fig.transFigure,
-        fontweight='bold',
         verticalalignment='bottom',
-        horizontalalignment='center',
-        fontsize='larger',
-        color='black',
+        **text_style,
     )
 
-    datetext = datetime.now().strftime(r'%Y-%m-%d')
-    timetext = datetime.now().strftime(r'%-I:%M %p ET')
+    now = datetime.now()
+    datetext = now.strftime(r'%Y-%m-%d')
+    timetext = now.strftime(r'%-I:%M %p ET')
 
     # timestamp below the images
     fig.text(
         x_center / fig.bbox.width,
         y_center / fig.bbox.height - text_yoff,
         f'Last updated:\n{timetext}\n{datetext}',
-        transform=fig.transFigure,
-        fontweight='bold',
         verticalalignment='top',
-        horizontalalignment='center',
-        fontsize='larger',
-        color='black',
+        **text_style,
     )
 
 
-def add_subplot_title(ax: plt.Axes, title: str):
+def bar_verts(x: np.ndarray, heights: list, width: float = BAR_WIDTH) -> list:
+    """Get the vertices of bars of the given heights centered on `x`, starting at 0"""
+    return [
+        [
+            (x0 - width / 2, 0),
+            (x0 - width / 2, h),
+            (x0 + width / 2, h),
+            (x0 + width / 2, 0),
+        ]
+        for x0, h in zip(x, heights)
+    ]
+
+
+def add_subplot_title(ax: Axes, title: str):
     ax.annotate(
         title,
         xy=(1, 1),
@@ -470,17 +574,43 @@ def add_subplot_title(ax: plt.Axes, title: str):
     )
 
 
-def date_formatter(ts: float, pos=None) -> str:
+def freeze_yticks(ax: Axes):
+    """Format the y tick labels in thousands once, using the final y limits, rather
+    than through a Python callback on every draw."""
+    ticks = ax.get_yticks()
+    labels = [thousands_label(y) for y in ticks]
+    ax.yaxis.set_major_locator(mpl.ticker.FixedLocator(ticks))
+    ax.yaxis.set_major_formatter(mpl.ticker.FixedFormatter(labels))
+
+
+def thousands_label(y: float) -> str:
+    """Format a tick value, in thousands if it's large, e.g. '15 K'."""
+    return f'{y / 1_000:.0f} K' if y >= 1_000 else f'{y:.0f}'
+
+
+def freeze_xticks(ax: Axes):
+    """Label the day ticks once, using the final x limits, rather than through a
+    Python callback on every draw."""
+    ticks = ax.get_xticks()
+    labels = [day_label(x) for x in ticks]
+    ax.xaxis.set_major_locator(mpl.ticker.FixedLocator(ticks))
+    ax.xaxis.set_major_formatter(mpl.ticker.FixedFormatter(labels))
+
+
+@functools.lru_cache
+def day_label(ts: float) -> str:
+    """Format a Matplotlib date as e.g. 'Oct. 09'. Cached, since the stacked plots
+    share the same day ticks."""
     dt: datetime = mpl.dates.num2date(ts)
-    month = dt.strftime('%b')
-    day = dt.strftime('%d')
 
-    return f'{month}{"." if month != "May" else ""} {day}'
+    return f'{MONTH_ABBREV[dt.month - 1]} {dt.day:02d}'
 
 
-def ax_no_data(ax: plt.Axes, title: str):
+def ax_no_data(ax: Axes, title: str):
     ax.tick_params(
         left=False,
+        right=False,
+        top=False,
         bottom=False,
         labelleft=False,
         labelbottom=False,
@@ -488,17 +618,64 @@ def ax_no_data(ax: plt.Axes, title: str):
     add_subplot_title(ax, f'{title}\nNo Data')
 
 
+@functools.lru_cache
+def load_resized_image(
+    name: str,
+    height: int,
+    resample: Image.Resampling,
+    mode: str | None = None,
+    padding: int = 0,
+) -> np.ndarray:
+    """Load a packaged image, resize it to `height` pixels preserving the aspect
+    ratio, and optionally pad it with a white border. Returned as a read-only array
+    for figimage. Cached, since the images and the figure size don't change between
+    plots.
+    """
+    img = Image.open(files('viswall_prom').joinpath(name))
+    if mode:
+        img = img.convert(mode)
+    width = int(height * img.width / img.height)
+    if (width, height) != img.size:
+        img = img.resize((width, height), resample)
+    if padding:
+        padded = Image.new(
+            img.mode, (width + 2 * padding, height + 2 * padding), 'white'
+        )
+        padded.paste(img, (padding, padding))
+        img = padded
+    arr = np.asarray(img)
+    arr.flags.writeable = False
+    return arr
+
+
+@functools.lru_cache
+def load_logo(qr_height: int, scc_height: int) -> np.ndarray:
+    """Composite the SCC icon, on a white background with 10 pixels of padding, over
+    the center of the Grafana QR code. Returned as a read-only RGB array. Cached
+    like `load_resized_image`.
+    """
+    qr = load_resized_image('grafana_qr.png', qr_height, Image.Resampling.NEAREST)
+    scc = load_resized_image(
+        'scc_icon.png', scc_height, Image.Resampling.LANCZOS, 'RGB', padding=10
+    )
+    logo = Image.fromarray(qr).convert('RGB')
+    logo.paste(
+        Image.fromarray(scc),
+        ((logo.width - scc.shape[1]) // 2, (logo.height - scc.shape[0]) // 2),
+    )
+    arr = np.asarray(logo)
+    arr.flags.writeable = False
+    return arr
+
+
 def unique_keys(dicts: list[dict]) -> set[str]:
     """Get a set of unique keys from a list of dictionaries"""
-    keys = set()
-    for d in dicts:
-        keys.update(d.keys())
-    return keys
+    return set(itertools.chain.from_iterable(dicts))
 
 
-def get_colors(registry, keys: list[str]) -> list[str]:
-    """Get colors for the given keys using the global KEY_TO_COLOR mapping."""
-    return [registry[key] for key in keys]
+def get_colors(registry: dict, keys: list[str]) -> tuple:
+    """Get colors for the given keys from a color registry, as an immutable tuple."""
+    return tuple(registry[k] for k in keys)
 
 
 def initialize_colors(
@@ -509,13 +686,17 @@ def initialize_colors(
     if fixed:
         registry.update(fixed)
 
-    # Then, assign fallback colors to remaining keys (sorted alphabetically)
     if type(fallback_cmap) is str:
         fallback_cmap = mpl.colormaps[fallback_cmap]
-    remaining_keys = sorted([k for k in keys if k not in registry])
+    # Look up each fallback color once, rather than calling the colormap per key
+    fallback_colors = tuple(map(fallback_cmap, range(len(fallback_cmap.colors))))
 
-    for idx, key in enumerate(remaining_keys):
-        registry[key] = fallback_cmap(idx % len(fallback_cmap.colors))
+    # Then, assign fallback colors to remaining keys (sorted alphabetically)
+    idx = 0
+    for key in sorted(keys):
+        if key not in registry:
+            registry[key] = fallback_colors[idx % len(fallback_colors)]
+            idx += 1
 
 
 def select_last(data):
@@ -530,32 +711,61 @@ def sort_and_group(data: dict, threshold: float) -> dict:
     # Flag any center below the cumulative threshold as eligible for grouping.
     # At the end, group those centers into an "Others" category.
 
-    data = {
-        k: v for (k, v) in sorted(data.items(), key=lambda kv: kv[1][-1], reverse=True)
-    }
+    keys = list(data.keys())
+    last = np.array([data[k][-1] for k in keys])
+    totals = np.array([data[k].sum() for k in keys], dtype=np.float64)
 
-    total_by_center = {k: sum(v) for k, v in data.items()}
-    total_by_center = {
-        k: v for (k, v) in sorted(total_by_center.items(), key=lambda kv: kv[1])
-    }
-    total = sum(total_by_center.values())
+    # Centers in decreasing order of the most recent value, and the same centers in
+    # increasing order of total usage (ties broken by the first order)
+    by_last = np.argsort(-last, kind='stable')
+    by_total = by_last[np.argsort(totals[by_last], kind='stable')]
 
-    small_centers = set()
-    others_sum = 0
-    for center, usage in total_by_center.items():
-        if (others_sum + usage) / total > threshold:
-            break
-        others_sum += usage
-        small_centers.add(center)
+    is_small = np.zeros(len(keys), dtype=bool)
+    is_small[by_total[np.cumsum(totals[by_total]) <= threshold * totals.sum()]] = True
 
-    if not small_centers:
-        return data
+    new_data = {keys[i]: data[keys[i]] for i in by_last if not is_small[i]}
+    if not is_small.any():
+        return new_data
 
-    new_data = {k: v for (k, v) in data.items() if k not in small_centers}
-    new_data['Others'] = np.sum([data[k] for k in small_centers], axis=0)
+    # Accumulate in place rather than stacking the small centers first
+    others = np.zeros_like(data[keys[0]])
+    for i in np.flatnonzero(is_small):
+        np.add(others, data[keys[i]], out=others)
+    new_data['Others'] = others
 
     return new_data
 
 
+def lttb_indices(y: np.ndarray, n_out: int) -> np.ndarray:
+    """Pick `n_out` indices of the evenly spaced series `y` with the
+    Largest-Triangle-Three-Buckets algorithm, which keeps its visual shape.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # The first and last points are always kept. The rest are split into buckets,
+    # and from each one we keep the point that makes the largest triangle with the
+    # previously kept point and the average of the next bucket.
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    idx = np.empty(n_out, dtype=int)
+    idx[0] = 0
+    idx[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = (edges[i + 1] + edges[i + 2] - 1) / 2
+            next_y = y[edges[i + 1] : edges[i + 2]].mean()
+        else:
+            next_x, next_y = n - 1, y[n - 1]
+        x = np.arange(lo, hi)
+        area = np.abs((a - next_x) * (y[lo:hi] - y[a]) - (a - x) * (next_y - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+
+    return idx
+
+
 if __name__ == '__main__':
     plot_usage()
@@ -4,19 +4,74 @@ Query Flatiron Prometheus for cluster usage data.
 Run this module directly to do a test query.
 """
 
+import hashlib
+import json
+import math
+import os
+import re
+import tempfile
+import time
 import warnings
 from datetime import datetime, timedelta
-from typing import Literal
+from pathlib import Path
+from typing import Literal, get_args
 
+import numpy as np
 import requests
 import urllib3
+from orjson import loads  # much faster than json on large range query responses
 
 PROMETHEUS_URL = {
     'popeye': 'http://popeye-prometheus.flatironinstitute.org:80',
     'rusty': 'http://prometheus.flatironinstitute.org:80',
 }
 
-NOW = datetime.now()
+CACHE_DIR = (
+    Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'viswall-prom'
+)
+# Responses that can still change are kept apart from the ones cached indefinitely,
+# so that a chunk cached while it was recent is never taken for a settled one
+RECENT_CACHE_DIR = CACHE_DIR / 'recent'
+
+# Range queries are split into chunks of about this many seconds
+CHUNK_SECONDS = 24 * 60 * 60
+
+# Past chunks of range queries are cached indefinitely. Results that can still
+# change are reused for this many seconds: the most recent chunk of a range query,
+# and instant queries.
+RECENT_CACHE_TTL = 5 * 60
+INSTANT_CACHE_TTL = 10
+
+# Expired responses are kept this long as a fallback for when Prometheus can't be
+# reached, then deleted by `prune_cache`
+STALE_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Samples are scraped and ingested with some delay, so a chunk is only treated as
+# past once it ended at least this many steps, plus `RECENT_CACHE_TTL`, ago
+SETTLE_STEPS = 3
+
+DURATION_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+    'w': 7 * 24 * 60 * 60,
+    'y': 365 * 24 * 60 * 60,
+}
+
+# Certificates aren't verified, so silence urllib3's warning about it. This is set
+# once here rather than with warnings.catch_warnings() around each request, which
+# isn't thread-safe and the queries are made from several threads.
+warnings.filterwarnings('ignore', category=urllib3.exceptions.InsecureRequestWarning)
+
+# Shared by all queries so that connections to Prometheus are kept alive and reused
+# rather than opened for every request. Its connection pool is thread-safe.
+SESSION = requests.Session()
+SESSION.verify = False
+
+# Seconds to wait for Prometheus to connect or send data. A stuck server then
+# fails the query, which can fall back to the cache, rather than hanging the plot.
+TIMEOUT = 30
 
 Cluster = Literal['popeye', 'rusty']
 Grouping = Literal['account', 'nodes', 'gputype', None]
@@ -29,37 +84,36 @@ def get_max_resource(
     step: str = '1h',
     resource: Resource = 'cpus',
     grouping: Grouping = 'nodes',
-) -> dict[list]:
+    cache: bool = True,
+    now: datetime | None = None,
+) -> dict:
     """
     Queries Prometheus API for the resource capacity in a cluster.
-    The result is a dict of list because the value may change as nodes go on- and off-line.
+    The result is a dict of arrays because the value may change as nodes go on- and off-line.
 
     Args:
         cluster: The name of the cluster to query
+        cache: Whether to use the on-disk cache of query responses
+        now: The time to query up to (default: the current time). Pass the same
+            value to all the queries for one plot so that their ranges line up.
 
     Returns:
         The maximum number of CPUs available in the cluster, keyed by node type.
         The result will also have a 'total' key.
     """
     do_range = days != 0
+    start_time, end_time = _time_range(days, now)
 
-    if do_range:
-        end_time = NOW
-        start_time = end_time - timedelta(days=days)
-    else:
-        start_time = NOW
-        end_time = None
-
-    query = _capacity_query(grouping, resource)
+    query = CAPACITY_QUERIES[grouping, resource]
     url = PROMETHEUS_URL[cluster.lower()]
-    result = _query(query, url, start_time, end_time, step)
+    result = _query(query, url, start_time, end_time, step, cache)
 
     if result:
         if do_range:
             result = _range_group_by(result, grouping)
-            result['total'] = [
-                sum(v) for v in zip(*(result[k] for k in result if k != 'timestamps'))
-            ]
+            result['total'] = np.sum(
+                [result[k] for k in result if k != 'timestamps'], axis=0
+            )
         else:
             result = _group_by(result, grouping)
             result['total'] = sum(result.values())
@@ -74,6 +128,8 @@ def get_usage_by(
     days: int,
     step: str = '1h',
     resource: Resource = 'cpus',
+    cache: bool = True,
+    now: datetime | None = None,
 ) -> dict:
     """
     Queries Prometheus API for CPU usage by the given grouping over a specified number of days.
@@ -81,22 +137,19 @@ def get_usage_by(
     Args:
         cluster: The name of the cluster to query
         days: The number of days to look back from today
+        cache: Whether to use the on-disk cache of query responses
+        now: The time to query up to (default: the current time). Pass the same
+            value to all the queries for one plot so that their ranges line up.
 
     Returns:
-        A dictionary with grouping names as keys and lists of usage values as values.
+        A dictionary with grouping names as keys and arrays of usage values as values.
     """
     do_range = days != 0
+    start_time, end_time = _time_range(days, now)
 
-    if do_range:
-        end_time = NOW
-        start_time = end_time - timedelta(days=days)
-    else:
-        start_time = NOW
-        end_time = None
-
-    query = _usage_query(grouping, resource)
+    query = USAGE_QUERIES[grouping, resource]
     url = PROMETHEUS_URL[cluster.lower()]
-    result = _query(query, url, start_time, end_time, step)
+    result = _query(query, url, start_time, end_time, step, cache)
 
     if result:
         if do_range:
@@ -107,6 +160,25 @@ def get_usage_by(
         return {}
 
 
+def _time_range(
+    days: int, now: datetime | None = None
+) -> tuple[datetime, datetime | None]:
+    """
+    Returns the start and end times for a query over the last `days` days up to
+    `now`, or just the start time for an instant query if `days` is 0.
+
+    If `now` isn't given, the current time is taken on every call rather than once
+    at import, so that a long-running process doesn't keep querying the same range.
+    Queries that should line up, like those for one plot, must share a `now`: a
+    step boundary can fall between separate calls.
+    """
+    if now is None:
+        now = datetime.now()
+    if days:
+        return now - timedelta(days=days), now
+    return now, None
+
+
 def _usage_query(grouping: Grouping, resource: Resource) -> str:
     """
     Generates a PromQL query for usage by the given grouping.
@@ -121,50 +193,126 @@ def _capacity_query(grouping: Grouping, resource: Resource) -> str:
     return f'sum {f"by({grouping})" if grouping else ""} (slurm_node_{resource}{{state!="drain",state!="down"}})'
 
 
+# Every query that can be made, built once. An unknown grouping or resource is a
+# KeyError here rather than a malformed query sent to Prometheus.
+USAGE_QUERIES = {
+    (g, r): _usage_query(g, r)
+    for g in get_args(Grouping)
+    if g
+    for r in get_args(Resource)
+}
+CAPACITY_QUERIES = {
+    (g, r): _capacity_query(g, r)
+    for g in get_args(Grouping)
+    for r in get_args(Resource)
+}
+
+
 def _query(
     query: str,
     url: str,
     start_time: datetime,
     end_time: datetime = None,
     step: str = None,
+    cache: bool = True,
 ) -> dict | None:
     """
     Queries Prometheus API for an instant or range of time and returns the result.
 
+    Range queries are aligned to the step and fetched in day-sized chunks. Chunks
+    that ended long enough ago won't change, so they are cached on disk
+    indefinitely. More recent chunks and instant queries are cached for
+    `RECENT_CACHE_TTL` and `INSTANT_CACHE_TTL` seconds. The last point of a range
+    query is at `end_time`, from an instant query, even if that isn't on a step.
+
     Args:
         query: The PromQL query string
         start_time: Start time as a datetime object
         end_time: End time as a datetime object
         step: Step between data points (e.g., "1h" for hourly data)
+        cache: Whether to read and write cached responses
     """
     do_range = True if end_time else False
     if do_range and not step:
         raise ValueError('Step must be provided for range queries')
 
-    url = f'{url}/api/v1/{"query_range" if do_range else "query"}'
-
-    params = {
-        'query': query,
-        'start': start_time.timestamp(),
-    }
-    if do_range:
-        params |= {
-            'end': end_time.timestamp(),
+    if not do_range:
+        params = {'query': query, 'time': start_time.timestamp()}
+        query_url = f'{url}/api/v1/query'
+        if cache:
+            return _cached_fetch(query_url, params, INSTANT_CACHE_TTL)
+        return _fetch(query_url, params)
+
+    step_seconds = _step_seconds(step)
+    chunk_seconds = step_seconds * math.ceil(CHUNK_SECONDS / step_seconds)
+    first = math.ceil(start_time.timestamp() / step_seconds) * step_seconds
+    last = math.floor(end_time.timestamp() / step_seconds) * step_seconds
+
+    # Chunks are aligned to multiples of their length so that they line up between
+    # calls. The first one is trimmed to `first` after merging.
+    query_url = f'{url}/api/v1/query_range'
+    results = []
+    aligned_first = first // chunk_seconds * chunk_seconds
+    settled = end_time.timestamp() - RECENT_CACHE_TTL - SETTLE_STEPS * step_seconds
+    for chunk_start in range(aligned_first, last + 1, chunk_seconds):
+        params = {
+            'query': query,
+            'start': chunk_start,
+            'end': min(chunk_start + chunk_seconds - step_seconds, last),
             'step': step,
         }
+        if not cache:
+            result = _fetch(query_url, params)
+        elif chunk_start + chunk_seconds <= settled:
+            result = _cached_fetch(query_url, params)
+        else:
+            result = _cached_fetch(query_url, params, RECENT_CACHE_TTL)
+        if result is None:
+            return None
+        results.append(result)
+
+    # The chunks end on the last step boundary, which can be most of a step ago,
+    # but the last point is shown as the current usage
+    if last < end_time.timestamp():
+        result = _query(query, url, end_time, cache=cache)
+        if result is None:
+            return None
+        results.append(_instant_as_range(result, end_time.timestamp()))
+
+    return _merge_range_results(results, first)
+
+
+def _fetch(url: str, params: dict) -> dict | None:
+    """
+    Sends a single query to the Prometheus API and returns the decoded response,
+    or None if the request or the query failed.
+    """
+    content = _get(url, params)
+    if content is None:
+        return None
+    return _decode(content)
+
 
+def _get(url: str, params: dict) -> bytes | None:
+    """
+    Sends a single query to the Prometheus API and returns the raw response body,
+    or None if the request failed.
+    """
     try:
-        # Temporarily disable SSL warnings
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore', urllib3.exceptions.InsecureRequestWarning)
-            response = requests.get(url, params=params, verify=False)
+        response = SESSION.get(url, params=params, timeout=TIMEOUT)
         response.raise_for_status()
     except requests.exceptions.RequestException as e:
         print(f'Error querying Prometheus: {e}')
         return None
+    return response.content
 
+
+def _decode(content: bytes) -> dict | None:
+    """
+    Decodes a Prometheus API response body, or returns None if the query failed.
+    """
     try:
-        result = response.json()
+        result = loads(content)
         if result['status'] != 'success':
             raise ValueError('Query failed')
     except (ValueError, KeyError) as e:
@@ -174,27 +322,150 @@ def _query(
     return result
 
 
+def _cached_fetch(url: str, params: dict, ttl: float | None = None) -> dict | None:
+    """
+    Like `_fetch`, but the response is stored in `CACHE_DIR` and reused on later
+    calls with the same arguments indefinitely, or in `RECENT_CACHE_DIR` for up to
+    `ttl` seconds if it is given. Only leave out `ttl` for queries whose result
+    can't change, i.e. ranges that settled in the past.
+
+    If the query fails, an expired cached response is returned instead, if it is
+    less than `STALE_CACHE_MAX_AGE` seconds old.
+    """
+    # Instant queries are keyed without their time, so that later calls find the
+    # entry and only its age decides whether it is used
+    key_params = {k: v for k, v in params.items() if k != 'time'}
+    key = json.dumps([url, key_params], sort_keys=True)
+    cache_dir = CACHE_DIR if ttl is None else RECENT_CACHE_DIR
+    path = cache_dir / f'{hashlib.sha256(key.encode()).hexdigest()}.json'
+
+    try:
+        mtime = path.stat().st_mtime
+        with open(path, 'rb') as f:
+            cached = loads(f.read())
+    except (OSError, ValueError):
+        cached = None
+
+    if cached is not None and (ttl is None or time.time() - mtime < ttl):
+        return cached
+    if cached is not None and time.time() - mtime >= STALE_CACHE_MAX_AGE:
+        cached = None
+
+    content = _get(url, params)
+    result = None if content is None else _decode(content)
+    if result is None:
+        if cached is not None:
+            print(f'Using cached response from {datetime.fromtimestamp(mtime)}')
+        return cached
+
+    # An empty result for a past range is more likely a gap in scraping than real,
+    # so don't keep it indefinitely
+    if ttl is None and not result['data']['result']:
+        return result
+
+    # The response is stored exactly as received, so there's nothing to re-encode
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=cache_dir, delete=False) as f:
+            f.write(content)
+        os.replace(f.name, path)
+    except OSError as e:
+        print(f'Error writing cache: {e}')
+
+    return result
+
+
+def prune_cache():
+    """
+    Deletes the responses in `RECENT_CACHE_DIR` that are too old to be used even as
+    a fallback. The recent chunk of a range query gets a new entry every step, so
+    without this the directory would keep growing.
+    """
+    cutoff = time.time() - STALE_CACHE_MAX_AGE
+    try:
+        paths = list(RECENT_CACHE_DIR.glob('*.json'))
+    except OSError:
+        return
+    for path in paths:
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            # Another run may have replaced or deleted it already
+            pass
+
+
+def _merge_range_results(results: list[dict], start: int) -> dict:
+    """
+    Concatenates the series of several Prometheus range query results covering
+    consecutive time ranges, dropping points before `start`.
+    """
+    merged = {}
+    for result in results:
+        for series in result['data']['result']:
+            key = tuple(sorted(series.get('metric', {}).items()))
+            if key not in merged:
+                merged[key] = {'metric': series.get('metric', {}), 'values': []}
+            merged[key]['values'] += [
+                p for p in series.get('values', []) if p[0] >= start
+            ]
+
+    return {
+        'status': 'success',
+        'data': {'resultType': 'matrix', 'result': list(merged.values())},
+    }
+
+
+def _instant_as_range(result: dict, timestamp: float) -> dict:
+    """
+    Converts a Prometheus instant query result to a range query result with one
+    point per series at `timestamp`, so that it can be merged with range results.
+    A cached result may be from a few seconds before `timestamp`, but it is still
+    placed there so that the queries for one plot line up.
+    """
+    return {
+        'status': 'success',
+        'data': {
+            'resultType': 'matrix',
+            'result': [
+                {'metric': s.get('metric', {}), 'values': [[timestamp, s['value'][1]]]}
+                for s in result['data']['result']
+            ],
+        },
+    }
+
+
+def _step_seconds(step: str) -> int:
+    """
+    Converts a Prometheus duration string like "1h" or "1h30m" to seconds.
+    """
+    matches = re.findall(r'(\d+)([smhdwy])', step)
+    if not matches or ''.join(n + u for n, u in matches) != step:
+        raise ValueError(f'Unsupported step: {step}')
+    return sum(int(n) * DURATION_UNITS[u] for n, u in matches)
+
+
 def _group_by(result: dict, metric: str) -> dict:
     """
-    Formats Prometheus instantaneous query results as a dictionary of values.
+    Formats Prometheus instantaneous query results as a dictionary of float32 values.
     """
     if not result or 'data' not in result or 'result' not in result['data']:
         return {}
 
-    data_dict = {}
-    for series in result['data']['result']:
-        if 'metric' in series and metric in series['metric']:
-            group = series['metric'][metric]
-            value = int(series['value'][1])  # value is the second item
-            data_dict[group] = value
+    series = [s for s in result['data']['result'] if metric in s.get('metric', ())]
+    groups = [s['metric'][metric] for s in series]
 
-    return data_dict
+    # Parse all the values in one call, as float32 like the range query series.
+    # The value is the second item.
+    values = np.array([s['value'][1] for s in series], dtype=np.float32)
+
+    return dict(zip(groups, values))
 
 
 def _range_group_by(result: dict, metric: str, missing=0) -> dict:
     """
-    Formats Prometheus range query results as a dictionary of lists.
-    Each key is a grouping value, and each value is a list of values.
+    Formats Prometheus range query results as a dictionary of arrays.
+    Each key is a grouping value, and each value is a float32 array of values.
     Ensures all time series are of the same length, filling missing values.
     """
 
@@ -202,32 +473,38 @@ def _range_group_by(result: dict, metric: str, missing=0) -> dict:
         return {}
 
     data_dict = {}
-    timestamps = set()
 
-    # First pass: collect all timestamps and create initial group entries
+    # First pass: parse each group's points into a (n, 2) array of timestamps and
+    # values
     for series in result['data']['result']:
         if 'metric' in series and metric in series['metric']:
             group = series['metric'][metric]
-            data_dict[group] = {}
-
-            # Add all timestamps to our set and associate values with timestamps
-            for point in series.get('values', []):
-                timestamp = point[0]  # timestamp is the first item
-                value = int(point[1])  # value is the second item
-                timestamps.add(timestamp)
-                data_dict[group][timestamp] = value
-
-    # Convert to sorted list of timestamps for consistent ordering
-    sorted_timestamps = sorted(timestamps)
-
-    # Second pass: ensure all groups have values for all timestamps
-    for group in data_dict:
-        values = []
-        for timestamp in sorted_timestamps:
-            values.append(data_dict[group].get(timestamp, missing))
-
-        # Replace the timestamp dict with the final list
-        data_dict[group] = values
+            points = series.get('values', [])
+            data_dict[group] = np.array(points, dtype=np.float64).reshape(-1, 2)
+
+    # Usually all series are scraped at the same, already sorted, times and the
+    # values can be used as they are. Otherwise, align them on the sorted union of
+    # all timestamps.
+    all_timestamps = [points[:, 0] for points in data_dict.values()]
+    sorted_timestamps = all_timestamps[0] if all_timestamps else np.empty(0)
+    aligned = all(
+        np.array_equal(sorted_timestamps, ts) for ts in all_timestamps[1:]
+    ) and np.all(np.diff(sorted_timestamps) > 0)
+
+    if aligned:
+        for group, points in data_dict.items():
+            data_dict[group] = points[:, 1].astype(np.float32)
+    else:
+        sorted_timestamps = np.unique(np.concatenate(all_timestamps or [[]]))
+
+        # Scatter each group's values into its row of one (groups, times) array, so
+        # all groups have values for all timestamps
+        values = np.full(
+            (len(data_dict), len(sorted_timestamps)), missing, dtype=np.float32
+        )
+        for row, (group, points) in zip(values, data_dict.items()):
+            row[np.searchsorted(sorted_timestamps, points[:, 0])] = points[:, 1]
+            data_dict[group] = row
 
     data_dict['timestamps'] = [datetime.fromtimestamp(ts) for ts in sorted_timestamps]
 